@@ -0,0 +1,84 @@
+import argparse
+import collections
+import csv
+import json
+import re
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+def collect_candidates(data_csv, queries_txt, query_weight):
+    # Normalized key -> [score, label]. Brands score by the number of their products, queries by their
+    # popularity rank, so that the most frequent query in the log gets the highest score.
+    candidates = {}
+
+    def add(label, score):
+        key = normalize(label)
+        if not key:
+            return
+        if key in candidates:
+            candidates[key][0] += score
+        else:
+            candidates[key] = [score, label.strip()]
+
+    if data_csv:
+        brands = collections.Counter()
+        with open(data_csv, encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if row.get("brand"):
+                    brands[row["brand"].strip()] += 1
+                if row.get("short"):
+                    add(f"{row.get('brand') or ''} {row['short']}", 1)
+        for brand, count in brands.items():
+            add(brand, count)
+
+    if queries_txt:
+        with open(queries_txt, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        for rank, query in enumerate(queries):
+            add(query, query_weight * (len(queries) - rank))
+
+    return candidates
+
+
+def build_index(candidates, top_k, max_scan):
+    keys = sorted(candidates)
+    scores = [candidates[key][0] for key in keys]
+    labels = [candidates[key][1] for key in keys]
+
+    # Prefixes matching more than `max_scan` keys get their top suggestions precomputed, all others are
+    # answered by scanning at most `max_scan` neighbouring keys of the sorted array.
+    prefix_counts = collections.Counter(key[:n] for key in keys for n in range(1, len(key) + 1))
+    top = {prefix: [] for prefix, count in prefix_counts.items() if count > max_scan}
+    for i in sorted(range(len(keys)), key=lambda i: -scores[i]):
+        for n in range(1, len(keys[i]) + 1):
+            suggestions = top.get(keys[i][:n])
+            if suggestions is not None and len(suggestions) < top_k:
+                suggestions.append(i)
+
+    return {"keys": keys, "labels": labels, "scores": scores, "top": top, "top_k": top_k}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the prefix index used by the /suggest endpoint")
+    parser.add_argument("--data_csv", default=None, help="CSV with extracted features, brand and short are used")
+    parser.add_argument("--queries_txt", default=None,
+                        help="Logged queries, one per line ordered by popularity (output of Extract Queries.ipynb)")
+    parser.add_argument("--output", required=True, help="JSON file to write the index to")
+    parser.add_argument("--query_weight", type=float, default=1.0, help="Multiplier of the query popularity scores")
+    parser.add_argument("--top_k", type=int, default=10, help="Number of suggestions precomputed per popular prefix")
+    parser.add_argument("--max_scan", type=int, default=64,
+                        help="Prefixes matching more keys than this get precomputed suggestions")
+    args = parser.parse_args()
+
+    candidates = collect_candidates(args.data_csv, args.queries_txt, args.query_weight)
+    index = build_index(candidates, args.top_k, args.max_scan)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    print(f"Wrote {len(index['keys'])} suggestions with {len(index['top'])} precomputed prefixes to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import csv
+from urllib.parse import urlparse
+
+import numpy as np
+import tqdm
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        # The smallest row of a cluster becomes its representative
+        if i < j:
+            self.parent[j] = i
+        elif j < i:
+            self.parent[i] = j
+
+
+def normalize_url(url):
+    parsed = urlparse(url)
+    return f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+
+
+def load_brands(data_csv, urls):
+    with open(data_csv) as f:
+        brands = {row["url"]: (row.get("brand") or "").strip().lower() for row in csv.DictReader(f)}
+    return [brands.get(url, "") for url in urls]
+
+
+# Random hyperplane LSH: rows whose signatures agree on all bits of at least one band land in the same bucket,
+# and only rows sharing a bucket are compared. Similar rows collide in some band with high probability, while
+# the number of compared pairs stays close to linear in the number of rows.
+def lsh_buckets(embeddings, num_bands, band_bits, seed):
+    rng = np.random.default_rng(seed)
+    planes = rng.standard_normal((embeddings.shape[1], num_bands * band_bits)).astype(np.float32)
+    weights = 1 << np.arange(band_bits, dtype=np.int64)
+    for band in range(num_bands):
+        bits = embeddings @ planes[:, band * band_bits:(band + 1) * band_bits] > 0
+        keys = bits.astype(np.int64) @ weights
+        order = np.argsort(keys, kind="stable")
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) > 1:
+                yield bucket
+
+
+def cluster(embeddings, urls, brands, threshold, num_bands, band_bits, max_bucket, seed):
+    clusters = UnionFind(len(urls))
+
+    # The same product under several URLs, e.g. with different query strings
+    first_row = {}
+    for i, url in enumerate(urls):
+        clusters.union(first_row.setdefault(normalize_url(url), i), i)
+
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    # Embeddings share a large common component, so hyperplanes through the origin would put most rows on the
+    # same side. Hashing the centered embeddings spreads them over the buckets.
+    buckets = lsh_buckets(embeddings - embeddings.mean(axis=0), num_bands, band_bits, seed)
+    for bucket in tqdm.tqdm(buckets, desc="Comparing buckets"):
+        # Huge buckets are compared block by block, so that the similarity matrix stays small
+        blocks = [bucket[start:start + max_bucket] for start in range(0, len(bucket), max_bucket)]
+        for n, block_a in enumerate(blocks):
+            for m, block_b in enumerate(blocks[n:], n):
+                similar = embeddings[block_a] @ embeddings[block_b].T >= threshold
+                if m == n:
+                    similar = np.triu(similar, k=1)
+                for a, b in zip(*np.nonzero(similar)):
+                    i, j = block_a[a], block_b[b]
+                    if brands is None or brands[i] == brands[j]:
+                        clusters.union(i, j)
+
+    return np.array([clusters.find(i) for i in range(len(urls))], dtype=np.int32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster near-duplicate products so that search shows one per cluster")
+    parser.add_argument("--urls_txt", required=True, help="URLs of the embedded products, one per line")
+    parser.add_argument("--embeddings_npy", required=True, help="Embeddings of the products, aligned with the URLs")
+    parser.add_argument("--data_csv", default=None, help="Extracted features, when set only same brand products are merged")
+    parser.add_argument("--output", required=True,
+                        help="NPY file with the row of the cluster representative for every row")
+    parser.add_argument("--threshold", type=float, default=0.97, help="Minimum cosine similarity of near-duplicates")
+    parser.add_argument("--num_bands", type=int, default=16, help="Number of LSH bands")
+    parser.add_argument("--band_bits", type=int, default=12, help="Number of hyperplanes per LSH band")
+    parser.add_argument("--max_bucket", type=int, default=2000, help="Maximum number of rows compared at once")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random hyperplanes")
+    args = parser.parse_args()
+
+    with open(args.urls_txt) as f:
+        urls = [url.strip() for url in f.readlines()]
+    embeddings = np.load(args.embeddings_npy).astype(np.float32)
+    brands = load_brands(args.data_csv, urls) if args.data_csv else None
+
+    clusters = cluster(embeddings, urls, brands, args.threshold, args.num_bands, args.band_bits, args.max_bucket,
+                       args.seed)
+    np.save(args.output, clusters)
+    num_clusters = int(np.sum(clusters == np.arange(len(clusters))))
+    print(f"{len(clusters)} products in {num_clusters} clusters, {len(clusters) - num_clusters} collapsed")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,14 @@ import csv
 import numpy as np
 
 def main(input_csv, urls_output, embeddings_output):
+    # Re-embedded URLs appear several times, the last row is current
     with open(input_csv) as f:
         reader = csv.reader(f)
-        urls = []
-        embeddings_list = []
+        rows = {}
         for row in reader:
-            urls.append(row[0])
-            embeddings_list.append(np.array(eval(row[1])))
+            rows[row[0]] = row[1]
+        urls = list(rows)
+        embeddings_list = [np.array(eval(embedding)) for embedding in rows.values()]
 
     embeddings_array = np.stack(embeddings_list, dtype=np.float32)
 
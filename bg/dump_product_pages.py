@@ -1,48 +1,207 @@
 import argparse
+import collections
+import heapq
+import itertools
 import os
-import queue
 import random
 import requests
+import sqlite3
 import sys
 import time
 import threading
 from urllib.parse import urlparse
-import yaml
 
 
 class Dispatcher:
-    def __init__(self, objects, closure, num_retries, parallelism):
+    def __init__(self, objects, closure, num_retries, parallelism, journal_file=None,
+                 retry_backoff=1.0, max_retry_backoff=300.0, stats_interval=10.0, fsync_interval=5.0):
         self.objects = objects
         self.closure = closure
         self.num_retries = num_retries
         self.parallelism = parallelism
-        self.task_queue = queue.Queue()
-        self.lock = threading.Lock()
+        self.journal_file = journal_file
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.stats_interval = stats_interval
+        self.fsync_interval = fsync_interval
+        # Guards the task queues, the journal and the stats, workers wait on it for new or delayed tasks
+        self.lock = threading.Condition()
         self.stop_event = threading.Event()
         self.threads = []
 
+        # Tasks ready to run, and failed tasks waiting for their retry time as a heap of
+        # (ready time, sequence number, object, retry count)
+        self.ready = collections.deque()
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+
+        # Objects that finished (successfully or not) and retry counts of the others, restored from the journal
+        self.finished = set()
+        self.retries = {}
+        self.journal = None
+        self.journal_lines = 0
+        self.last_fsync = time.monotonic()
+        if self.journal_file:
+            self._restore_journal()
+
         # Prepare the task queue with the objects and their retry counts
         for obj in self.objects:
-            self.task_queue.put((obj, 0))
+            if obj not in self.finished:
+                self.ready.append((obj, self.retries.get(obj, 0)))
+
+        self.total = len(self.ready)
+        self.succeeded = 0
+        self.failed = 0
+        self.window = collections.deque()
+        self.started = self.last_stats = time.monotonic()
+
+    # The journal is an append-only log of "done", "failed" and "retry" lines, one per event, so that a crash
+    # loses at most the events that were not flushed yet.
+    def _restore_journal(self):
+        if os.path.exists(self.journal_file):
+            torn_bytes = 0
+            with open(self.journal_file, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # Partially written last line, it is cut off below so that new lines start cleanly
+                        torn_bytes = len(line.encode())
+                        continue
+                    fields = line[:-1].split("\t")
+                    if fields[0] in ("done", "failed") and len(fields) == 2:
+                        self.finished.add(fields[1])
+                        self.retries.pop(fields[1], None)
+                    elif fields[0] == "retry" and len(fields) == 3:
+                        try:
+                            self.retries[fields[1]] = int(fields[2])
+                        except ValueError:
+                            continue
+                    else:
+                        continue
+                    self.journal_lines += 1
+            if torn_bytes:
+                os.truncate(self.journal_file, os.path.getsize(self.journal_file) - torn_bytes)
+            print(f"Restored {len(self.finished)} finished tasks from {self.journal_file}")
+        self.journal = open(self.journal_file, "a")
+        self._maybe_compact()
+
+    def _write_journal(self, *fields):
+        if self.journal is None:
+            return
+        self.journal.write("\t".join(str(field) for field in fields) + "\n")
+        self.journal.flush()
+        self.journal_lines += 1
+        if time.monotonic() - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.journal.fileno())
+            self.last_fsync = time.monotonic()
+        self._maybe_compact()
+
+    # Rewrites the journal without superseded "retry" lines once they make up more than half of it.
+    def _maybe_compact(self):
+        live_lines = len(self.finished) + len(self.retries)
+        if self.journal_lines <= 2 * live_lines + 1000:
+            return
+        tmp_file = self.journal_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for obj in self.finished:
+                f.write(f"done\t{obj}\n")
+            for obj, retries in self.retries.items():
+                f.write(f"retry\t{obj}\t{retries}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal.close()
+        os.replace(tmp_file, self.journal_file)
+        self.journal = open(self.journal_file, "a")
+        self.journal_lines = live_lines
+
+    def _next_task(self):
+        with self.lock:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, obj, retries = heapq.heappop(self.delayed)
+                    self.ready.append((obj, retries))
+                if self.ready:
+                    self.in_flight += 1
+                    return self.ready.popleft()
+                if not self.delayed and self.in_flight == 0:
+                    # Nothing left to do
+                    return None
+                self.lock.wait(self.delayed[0][0] - now if self.delayed else None)
+            return None
+
+    def _retry_delay(self, retries):
+        # Exponential backoff with jitter, so that failed tasks do not hit the origin all at once
+        delay = min(self.max_retry_backoff, self.retry_backoff * 2 ** retries)
+        return delay / 2 + random.uniform(0, delay / 2)
 
     def _worker(self):
-        while not self.stop_event.is_set():
-            try:
-                obj, retries = self.task_queue.get(timeout=1)
-            except queue.Empty:
-                continue
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            obj, retries = task
 
             try:
                 self.closure(obj)
             except Exception as e:
                 print(f"Task failed: {e} (retry: {retries})")
                 with self.lock:
+                    self._record(False)
                     if retries < self.num_retries:
-                        self.task_queue.put((obj, retries + 1))
+                        delay = self._retry_delay(retries)
+                        heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), obj, retries + 1))
+                        self.retries[obj] = retries + 1
+                        self._write_journal("retry", obj, retries + 1)
                     else:
                         print(f"Task failed after {self.num_retries} retries: {e}")
+                        self.failed += 1
+                        self._finish(obj, "failed")
+            else:
+                with self.lock:
+                    self._record(True)
+                    self.succeeded += 1
+                    self._finish(obj, "done")
             finally:
-                self.task_queue.task_done()
+                with self.lock:
+                    self.in_flight -= 1
+                    self.lock.notify_all()
+
+    def _finish(self, obj, status):
+        self.finished.add(obj)
+        self.retries.pop(obj, None)
+        self._write_journal(status, obj)
+
+    def _record(self, success):
+        now = time.monotonic()
+        self.window.append((now, success))
+        while self.window and self.window[0][0] < now - 60:
+            self.window.popleft()
+        if now - self.last_stats >= self.stats_interval:
+            self.last_stats = now
+            print(self.format_stats())
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = min(60, max(1e-3, now - self.started))
+            successes = sum(1 for _, success in self.window if success)
+            throughput = successes / elapsed
+            remaining = self.total - self.succeeded - self.failed
+            return {
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "remaining": remaining,
+                "throughput": throughput,
+                "error_rate": (len(self.window) - successes) / max(1, len(self.window)),
+                "eta": remaining / throughput if throughput else None,
+            }
+
+    def format_stats(self):
+        stats = self.stats()
+        eta = time.strftime("%H:%M:%S", time.gmtime(stats["eta"])) if stats["eta"] is not None else "unknown"
+        return (f"Progress: {stats['succeeded']} done, {stats['failed']} failed, {stats['remaining']} remaining, "
+                f"{stats['throughput']:.2f} tasks/s, errors {stats['error_rate']:.1%} (last minute), ETA {eta}")
 
     def start(self):
         for _ in range(self.parallelism):
@@ -52,38 +211,62 @@ class Dispatcher:
 
     def stop(self):
         self.stop_event.set()
+        with self.lock:
+            self.lock.notify_all()
 
         for t in self.threads:
             t.join()
 
     def state(self):
         with self.lock:
-            remaining_tasks = list(self.task_queue.queue)
+            remaining_tasks = list(self.ready) + [(obj, retries) for _, _, obj, retries in self.delayed]
         return remaining_tasks
 
     def join(self):
         for t in self.threads:
             t.join()
 
-    def restore(self, state):
+    def close(self):
         with self.lock:
-            self.task_queue = queue.Queue()
+            if self.journal is not None:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+                self.journal = None
+
+
+# Sitemap lastmod and ETag / Last-Modified of every downloaded page, shared by the worker threads.
+class FreshnessStore:
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages "
+                        "(url TEXT PRIMARY KEY, lastmod TEXT, etag TEXT, last_modified TEXT)")
+        self.db.commit()
 
-            for task in state:
-                self.task_queue.put(task)
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT lastmod, etag, last_modified FROM pages WHERE url = ?", (url,)).fetchone()
+        return row or (None, None, None)
 
-            self.threads = []
+    def record(self, url, lastmod, etag, last_modified):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (url, lastmod, etag, last_modified))
+            self.db.commit()
 
 
 class Downloader:
-    def __init__(self, save_directory, scrape_api_key=None):
+    def __init__(self, save_directory, scrape_api_key=None, freshness_db=None, lastmods=None):
         self.save_directory = save_directory
         self.scrape_api_key = scrape_api_key
+        self.freshness = FreshnessStore(freshness_db) if freshness_db else None
+        self.lastmods = lastmods or {}
 
         # Create the save directory if it does not exist
         os.makedirs(save_directory, exist_ok=True)
 
-    def _download_url(self, url):
+    def _download_url(self, url, conditional_headers=None):
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.82 Safari/537.36"
         }
@@ -96,12 +279,14 @@ class Downloader:
             }
             response = requests.get(api_url, headers=headers, params=params, allow_redirects=False)
         else:
+            # ScraperAPI does not forward request headers, so only direct requests can be conditional.
+            headers.update(conditional_headers or {})
             response = requests.get(url, headers=headers, allow_redirects=False)
 
-        if response.status_code != 200:
+        if response.status_code not in (200, 304):
             raise Exception(f"Failed to download URL: {url} (status: {response.status_code})")
 
-        return response.content
+        return response
 
     def _save_file(self, content, filename):
         with open(filename, "wb") as f:
@@ -113,36 +298,72 @@ class Downloader:
         file_base = path_parts[-1].split("?")[0]
         return  os.path.join(self.save_directory, f"{file_base}.html")
 
-    def run(self, url):
+    # Returns True if new content was saved, False if the existing file is up to date. `lastmod` defaults to
+    # the one read from the URLs file.
+    def run(self, url, lastmod=None):
         filename = self._get_filename(url)
-        # If exists, skip downloading
+        lastmod = lastmod or self.lastmods.get(url)
+        conditional_headers = {}
         if os.path.exists(filename):
-            print(f"Skipping download of {url}")
-            return
+            # Without freshness information, skip downloading if the file exists
+            if self.freshness is None:
+                print(f"Skipping download of {url}")
+                return False
+            stored_lastmod, etag, last_modified = self.freshness.get(url)
+            if lastmod and lastmod == stored_lastmod:
+                print(f"Skipping download of {url} (lastmod {lastmod} not changed)")
+                return False
+            if etag:
+                conditional_headers["If-None-Match"] = etag
+            if last_modified:
+                conditional_headers["If-Modified-Since"] = last_modified
 
         print(f"Starting download of {url}")
-        content = self._download_url(url)
-        self._save_file(content, filename)
-        print(f"Downloaded {url}")
+        response = self._download_url(url, conditional_headers)
+        if response.status_code == 304:
+            print(f"Not modified {url}")
+        else:
+            self._save_file(response.content, filename)
+            print(f"Downloaded {url}")
+        if self.freshness is not None:
+            if response.status_code == 304:
+                _, etag, last_modified = self.freshness.get(url)
+            else:
+                etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            self.freshness.record(url, lastmod, etag, last_modified)
+        return response.status_code != 304
 
 
 def main():
     parser = argparse.ArgumentParser(description="Download URLs using Dispatcher and Downloader")
     parser.add_argument("--urls_file", required=True, help="Path to the file containing URLs to download (one URL per line)")
-    parser.add_argument("--state_file", required=True, help="Path to the file containing the saved state of Dispatcher")
+    parser.add_argument("--state_file", required=True,
+                        help="Path to the journal of finished tasks of Dispatcher, appended to while running")
     parser.add_argument("--save_directory", required=True, help="Directory to save downloaded files")
     parser.add_argument("--scrape_api_key", default=None, help="ScrapeAPI key (optional)")
     parser.add_argument("--num_retries", type=int, default=3, help="Number of retries for each download task")
     parser.add_argument("--parallelism", type=int, default=5, help="Number of parallel download tasks")
+    parser.add_argument("--retry_backoff", type=float, default=1.0,
+                        help="Delay in seconds before the first retry, doubled with every further retry")
+    parser.add_argument("--stats_interval", type=float, default=10.0, help="Seconds between progress reports")
+    parser.add_argument("--freshness_db", default=None,
+                        help="SQLite file with lastmod / ETag / Last-Modified of downloaded pages (optional). "
+                             "When set, existing pages are re-downloaded only if they changed")
 
     args = parser.parse_args()
 
-    # Read URLs from the file
+    # Read URLs from the file, lines may have a tab separated sitemap lastmod
+    urls = []
+    lastmods = {}
     with open(args.urls_file, "r") as f:
-        urls = [line.strip() for line in f.readlines()]
+        for line in f.readlines():
+            url, _, lastmod = line.strip().partition("\t")
+            urls.append(url)
+            if lastmod:
+                lastmods[url] = lastmod
 
     # Initialize Downloader and Dispatcher
-    downloader = Downloader(args.save_directory, args.scrape_api_key)
+    downloader = Downloader(args.save_directory, args.scrape_api_key, args.freshness_db, lastmods)
     def mock_runner(url):
         # Random number of seconds between 1 and 3
         time.sleep(random.randint(1, 3))
@@ -155,29 +376,21 @@ def main():
     # dispatcher = Dispatcher(urls, mock_runner, args.num_retries, args.parallelism)
 
 
-    dispatcher = Dispatcher(urls, downloader.run, args.num_retries, args.parallelism)
-
-    # Restore state if the state file exists
-    if os.path.exists(args.state_file):
-        print(f"Restoring Dispatcher state from {args.state_file}...")
-        with open(args.state_file, "r") as f:
-            state = yaml.safe_load(f)
-        dispatcher.restore(state)
+    # Finished tasks are restored from the journal if it exists
+    dispatcher = Dispatcher(urls, downloader.run, args.num_retries, args.parallelism, args.state_file,
+                            retry_backoff=args.retry_backoff, stats_interval=args.stats_interval)
 
     try:
         dispatcher.start()
         dispatcher.join()
+        print(dispatcher.format_stats())
     except KeyboardInterrupt:
         print("Stopping Dispatcher...")
         dispatcher.stop()
-
-        # Save the state to the disk as YAML
-        state = dispatcher.state()
-        with open(args.state_file, "w") as f:
-            yaml.safe_dump(state, f)
-
+        dispatcher.close()
         print("Dispatcher state saved.")
         sys.exit(0)
+    dispatcher.close()
 
 
 if __name__ == "__main__":
@@ -43,21 +43,33 @@ def main():
     parser.add_argument("--input-dir", required=True, help="The directory containing the downloaded HTML files")
     parser.add_argument("--config-file", required=True, help="The YAML configuration file with feature names, XPaths and optional Regexes")
     parser.add_argument("--output-file", required=True, help="The CSV file to write the extracted features to")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Append rows only for HTML files changed since the output file was last written. "
+                             "Later rows for the same URL replace earlier ones, docs_embedd.py re-embeds a URL "
+                             "when its document changed")
     args = parser.parse_args()
 
     with open(args.config_file, "r") as f:
         feature_config = yaml.safe_load(f)
 
+    # Pages that were not re-downloaded keep their old mtime and their rows are already in the output
+    since = None
+    if args.incremental and os.path.exists(args.output_file):
+        since = os.path.getmtime(args.output_file)
+
     # Create the CSV file and write the header row
-    with open(args.output_file, "w", newline="", encoding="utf-8") as csvfile:
+    with open(args.output_file, "w" if since is None else "a", newline="", encoding="utf-8") as csvfile:
         fieldnames = list(feature_config.keys())
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+        if since is None:
+            writer.writeheader()
 
         for file in tqdm.tqdm(os.listdir(args.input_dir)):
             if not file.endswith(".html"):
                 continue
             file_path = os.path.join(args.input_dir, file)
+            if since is not None and os.path.getmtime(file_path) <= since:
+                continue
             if os.path.isfile(file_path):
                 features = extract_features(file_path, feature_config)
                 writer.writerow(features)
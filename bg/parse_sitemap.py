@@ -1,10 +1,16 @@
 import argparse
+import queue
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 import gzip
 from io import BytesIO
+import zlib
 
 
+SITEMAP_NS = {"sit": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.82 Safari/537.36'
 }
@@ -23,21 +29,114 @@ def download_xml_file(url):
 
 def parse_individual_sitemap(xml_content):
     root = ElementTree.fromstring(xml_content)
-    urls = [element.text
-            for element in
-            root.findall('.//sit:loc', namespaces={"sit": "http://www.sitemaps.org/schemas/sitemap/0.9"})]
+    urls = []
+    for element in root.findall('.//sit:url', namespaces=SITEMAP_NS):
+        lastmod = element.findtext('sit:lastmod', namespaces=SITEMAP_NS)
+        urls.append((element.findtext('sit:loc', namespaces=SITEMAP_NS), lastmod and lastmod.strip()))
     print(f'Found {len(urls)} URLs in the sitemap.')
     return urls
 
+# Yields (url, lastmod) pairs while the sitemap is being downloaded, decompressing gzipped sitemaps on the fly.
+# Parsed elements are dropped right away, so memory does not grow with the sitemap size.
+def stream_individual_sitemap(url, chunk_size=64 * 1024):
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    decompressor = None
+    root = None
+    count = 0
+    with requests.get(url, headers=HEADERS, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for i, chunk in enumerate(response.iter_content(chunk_size)):
+            if i == 0 and chunk[:2] == b'\x1f\x8b':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+            for event, element in parser.read_events():
+                if root is None:
+                    root = element
+                elif event == 'end' and element.tag == '{%s}url' % SITEMAP_NS['sit']:
+                    lastmod = element.findtext('sit:lastmod', namespaces=SITEMAP_NS)
+                    yield element.findtext('sit:loc', namespaces=SITEMAP_NS), lastmod and lastmod.strip()
+                    root.remove(element)
+                    count += 1
+    parser.close()
+    print(f'Found {count} URLs in {url}.')
+
+# Downloads the sitemaps concurrently and yields their (url, lastmod) pairs as soon as they are parsed.
+# The queue between the downloads and the consumer is bounded, so a slow consumer pauses the downloads.
+# A sitemap that fails to download or parse raises its error in the consumer.
+def stream_sitemaps(sitemap_urls, concurrency, batch_size=1000):
+    batches = queue.Queue(maxsize=concurrency * 4)
+    stop = threading.Event()
+    done = object()
+
+    # Returns False once the consumer is gone, so that workers never stay blocked on a full queue
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker(sitemap_url):
+        try:
+            batch = []
+            for item in stream_individual_sitemap(sitemap_url):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if put(batch):
+                put(done)
+        except Exception as e:
+            print(f'Failed to parse {sitemap_url}: {e}')
+            put(e)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for sitemap_url in sitemap_urls:
+            executor.submit(worker, sitemap_url)
+        remaining = len(sitemap_urls)
+        while remaining:
+            batch = batches.get()
+            if batch is done:
+                remaining -= 1
+            elif isinstance(batch, Exception):
+                raise batch
+            else:
+                yield from batch
+    finally:
+        # Also runs when the consumer stops early, e.g. on Ctrl-C or a write error
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def write_url(output_file, url, lastmod=None):
+    if lastmod:
+        output_file.write(f'{url}\t{lastmod}\n')
+    else:
+        output_file.write(f'{url}\n')
+
 def main():
     parser = argparse.ArgumentParser(description='Download and parse XML files from a sitemap.')
     parser.add_argument('--sitemap_url', type=str, required=True, help='URL of the main sitemap file.')
     parser.add_argument('--output', type=str, required=True, help='File to dump the list of all URLs.')
+    parser.add_argument('--lastmod', action='store_true',
+                        help='Write "<url>\\t<lastmod>" lines, so that dump_product_pages.py can skip unchanged pages.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Download sitemaps concurrently and write URLs while parsing, with constant memory.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of sitemaps downloaded in parallel.')
 
     args = parser.parse_args()
 
     main_sitemap_urls = parse_main_sitemap(args.sitemap_url)
 
+    if args.stream:
+        with open(args.output, 'w') as output_file:
+            for url, lastmod in stream_sitemaps(main_sitemap_urls[2:], args.concurrency):
+                write_url(output_file, url, lastmod if args.lastmod else None)
+        return
+
     all_urls = []
 
     for i, sitemap_url in enumerate(main_sitemap_urls):
@@ -48,8 +147,8 @@ def main():
         all_urls.extend(urls)
 
     with open(args.output, 'w') as output_file:
-        for url in all_urls:
-            output_file.write(f'{url}\n')
+        for url, lastmod in all_urls:
+            write_url(output_file, url, lastmod if args.lastmod else None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,367 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import openai
+import tenacity
+import yaml
+
+from dump_product_pages import Downloader
+from extract_features import extract_features
+from parse_sitemap import parse_main_sitemap, stream_sitemaps
+
+
+# Marks the end of the stream of items, every stage passes it on once all its workers are done
+STOP = object()
+
+
+# Per-URL progress of the pipeline, so that a restarted pipeline resumes every item after the last stage
+# it finished, and a re-crawl skips items whose sitemap lastmod did not change.
+class ProgressStore:
+    FINAL_STAGES = ("indexed", "skipped")
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items (url TEXT PRIMARY KEY, lastmod TEXT, stage TEXT, features TEXT)")
+        self.db.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT lastmod, stage, features FROM items WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None, None, None
+        return row[0], row[1], json.loads(row[2]) if row[2] else None
+
+    def set(self, items, stage):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                                [(item["url"], item.get("lastmod"), stage,
+                                  json.dumps(item["features"]) if item.get("features") else None)
+                                 for item in items])
+            self.db.commit()
+
+
+# A pipeline stage: `concurrency` worker threads take items from a bounded input queue, process them and put
+# the results into the input queue of the next stage. A full queue blocks the previous stage (backpressure).
+# With `batch_size` > 1, `process` gets a list of items and returns a list of results. A failed batch is
+# retried up to `num_retries` times with exponential backoff before it is counted as failed.
+class Stage:
+    def __init__(self, name, process, concurrency, queue_size, batch_size=1, num_retries=0, retry_backoff=1.0,
+                 max_retry_backoff=300.0):
+        self.name = name
+        self.process = process
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.num_retries = num_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.input = queue.Queue(maxsize=queue_size)
+        self.output = None
+        self.lock = threading.Lock()
+        self.running = concurrency
+        self.processed = 0
+        self.failed = 0
+        self.threads = []
+
+    def start(self):
+        for _ in range(self.concurrency):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _next_batch(self):
+        item = self.input.get()
+        if item is STOP:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.input.get_nowait()
+            except queue.Empty:
+                break
+            if item is STOP:
+                # Leave it for the other workers, this batch is still processed
+                self.input.put(STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _retry_delay(self, retries):
+        # Same equal jitter backoff as the Dispatcher in dump_product_pages.py
+        delay = min(self.max_retry_backoff, self.retry_backoff * 2 ** retries)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _process(self, batch):
+        for retries in range(self.num_retries + 1):
+            try:
+                if self.batch_size > 1:
+                    return self.process(batch)
+                result = self.process(batch[0])
+                return [] if result is None else [result]
+            except Exception as e:
+                if retries == self.num_retries:
+                    raise
+                delay = self._retry_delay(retries)
+                print(f"{self.name} failed for {', '.join(item['url'] for item in batch)}: {e}, "
+                      f"retrying in {delay:.1f}s (retry: {retries + 1})")
+                time.sleep(delay)
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                results = self._process(batch)
+            except Exception as e:
+                print(f"{self.name} failed for {', '.join(item['url'] for item in batch)}: {e}")
+                with self.lock:
+                    self.failed += len(batch)
+                continue
+            with self.lock:
+                self.processed += len(batch)
+            if self.output is not None:
+                for result in results:
+                    self.output.put(result)
+
+        # Let the other workers see the end of the stream, the last one passes it to the next stage
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if not last:
+            self.input.put(STOP)
+        elif self.output is not None:
+            self.output.put(STOP)
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+    def stats(self):
+        return f"{self.name}: {self.processed} done, {self.failed} failed, {self.input.qsize()} queued"
+
+
+# Collects embedded products and writes them as index delta segments: every `segment_interval` seconds or
+# `segment_size` items a new directory with urls.txt, embedds.npy and data.csv appears in `segments_dir`,
+# which search_server.py picks up without a restart. A later segment replaces products of earlier ones.
+class SegmentWriter:
+    def __init__(self, segments_dir, fieldnames, progress, segment_size, segment_interval, queue_size):
+        self.segments_dir = segments_dir
+        self.fieldnames = fieldnames
+        self.progress = progress
+        self.segment_size = segment_size
+        self.segment_interval = segment_interval
+        self.input = queue.Queue(maxsize=queue_size)
+        self.buffer = []
+        self.segments = 0
+        self.processed = 0
+        self.failed = 0
+        self.thread = None
+        os.makedirs(segments_dir, exist_ok=True)
+        self.next_segment = len([d for d in os.listdir(segments_dir) if not d.endswith(".tmp")])
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, last_flush + self.segment_interval - time.monotonic())
+            try:
+                item = self.input.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is STOP:
+                break
+            if item is not None:
+                self.buffer.append(item)
+            if len(self.buffer) >= self.segment_size or time.monotonic() - last_flush >= self.segment_interval:
+                self.flush()
+                last_flush = time.monotonic()
+        self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        name = f"{self.next_segment:06d}"
+        tmp_dir = os.path.join(self.segments_dir, name + ".tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, "urls.txt"), "w") as f:
+            for item in self.buffer:
+                f.write(item["features"]["url"] + "\n")
+        np.save(os.path.join(tmp_dir, "embedds.npy"), np.array([item["embedding"] for item in self.buffer],
+                                                                dtype=np.float32))
+        with open(os.path.join(tmp_dir, "data.csv"), "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames)
+            writer.writeheader()
+            for item in self.buffer:
+                writer.writerow(item["features"])
+        # The server only loads complete segments, so publish the directory with a single rename
+        os.replace(tmp_dir, os.path.join(self.segments_dir, name))
+        self.progress.set(self.buffer, "indexed")
+        print(f"Wrote segment {name} with {len(self.buffer)} products")
+        self.processed += len(self.buffer)
+        self.segments += 1
+        self.next_segment += 1
+        self.buffer = []
+
+    def join(self):
+        self.thread.join()
+
+    def stats(self):
+        return f"index: {self.processed} indexed in {self.segments} segments, {self.input.qsize()} queued"
+
+
+@tenacity.retry(wait=tenacity.wait_exponential(min=1, max=60), stop=tenacity.stop_after_attempt(10))
+def get_embeds(docs):
+    embeds = openai.Embedding.create(input=docs, engine="text-embedding-ada-002")
+    return [row["embedding"] for row in sorted(embeds["data"], key=lambda row: row["index"])]
+
+
+class Pipeline:
+    def __init__(self, args):
+        with open(args.config_file, "r") as f:
+            self.feature_config = yaml.safe_load(f)
+        self.template = args.template
+        self.progress = ProgressStore(args.progress_db)
+        self.downloader = Downloader(args.save_directory, args.scrape_api_key, args.freshness_db)
+
+        self.download = Stage("download", self._download, args.download_concurrency, args.queue_size,
+                              num_retries=args.num_retries, retry_backoff=args.retry_backoff)
+        self.extract = Stage("extract", self._extract, args.extract_concurrency, args.queue_size)
+        self.embed = Stage("embed", self._embed, args.embed_concurrency, args.queue_size,
+                           batch_size=args.embed_batch_size)
+        self.index = SegmentWriter(args.segments_dir, list(self.feature_config.keys()), self.progress,
+                                   args.segment_size, args.segment_interval, args.queue_size)
+        self.download.output = self.extract.input
+        self.extract.output = self.embed.input
+        self.embed.output = self.index.input
+        self.stages = [self.download, self.extract, self.embed, self.index]
+        self.feed_error = None
+
+    # Sends every item to the first stage it still has to go through.
+    def _dispatch(self, url, lastmod):
+        stored_lastmod, stage, features = self.progress.get(url)
+        item = {"url": url, "lastmod": lastmod}
+        if stage is None or (lastmod or None) != stored_lastmod:
+            self.download.input.put(item)
+        elif stage in ProgressStore.FINAL_STAGES:
+            # Without a lastmod the page is revalidated with a conditional request
+            if not lastmod:
+                self.download.input.put(item)
+        elif stage == "downloaded":
+            self.extract.input.put(item)
+        elif stage == "extracted":
+            item["features"] = features
+            self.embed.input.put(item)
+
+    def _download(self, item):
+        changed = self.downloader.run(item["url"], item["lastmod"])
+        _, stage, _ = self.progress.get(item["url"])
+        if not changed and stage in ProgressStore.FINAL_STAGES:
+            return None
+        self.progress.set([item], "downloaded")
+        return item
+
+    def _extract(self, item):
+        features = extract_features(self.downloader._get_filename(item["url"]), self.feature_config)
+        # The canonical URL is found on almost every page, but only product pages have a brand or name
+        if not features.get("brand") and not features.get("short"):
+            # Not a product page
+            self.progress.set([item], "skipped")
+            return None
+        item["features"] = {name: "" if value is None else value for name, value in features.items()}
+        self.progress.set([item], "extracted")
+        return item
+
+    def _embed(self, items):
+        embeds = get_embeds([self.template.format(**item["features"]) for item in items])
+        for item, embed in zip(items, embeds):
+            item["embedding"] = embed
+        return items
+
+    def run(self, sources, stats_interval):
+        for stage in self.stages:
+            stage.start()
+
+        feeder = threading.Thread(target=self._feed, args=(sources,), daemon=True)
+        feeder.start()
+        while self.index.thread.is_alive():
+            self.index.thread.join(stats_interval)
+            print(" | ".join(stage.stats() for stage in self.stages))
+        if self.feed_error is not None:
+            raise self.feed_error
+
+    def _feed(self, sources):
+        try:
+            for url, lastmod in sources:
+                self._dispatch(url, lastmod)
+        except Exception as e:
+            # Items read so far still go through the pipeline, run() raises the error once they are indexed
+            print(f"Failed to read the URLs: {e}")
+            self.feed_error = e
+        finally:
+            self.download.input.put(STOP)
+
+
+def read_urls_file(urls_file):
+    with open(urls_file, "r") as f:
+        for line in f:
+            url, _, lastmod = line.strip().partition("\t")
+            if url:
+                yield url, lastmod or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl, extract, embed and index products as one streaming pipeline")
+    parser.add_argument("--sitemap_url", default=None, help="URL of the main sitemap file")
+    parser.add_argument("--urls_file", default=None,
+                        help="File with URLs to process instead of a sitemap, with optional tab separated lastmods")
+    parser.add_argument("--sitemap_concurrency", type=int, default=4, help="Number of sitemaps downloaded in parallel")
+    parser.add_argument("--save_directory", required=True, help="Directory to save downloaded files")
+    parser.add_argument("--scrape_api_key", default=None, help="ScrapeAPI key (optional)")
+    parser.add_argument("--freshness_db", default=None,
+                        help="SQLite file with lastmod / ETag / Last-Modified of downloaded pages (optional)")
+    parser.add_argument("--progress_db", required=True, help="SQLite file with the pipeline progress of every URL")
+    parser.add_argument("--config_file", required=True,
+                        help="The YAML configuration file with feature names, XPaths and optional Regexes")
+    parser.add_argument("--template", required=True, help="Template of the embedded document, e.g. '{brand} {short}'")
+    parser.add_argument("--openai_key", default=os.environ.get("OPENAI_API_KEY"), help="OpenAI API key")
+    parser.add_argument("--segments_dir", required=True, help="Directory to write index delta segments to")
+    parser.add_argument("--segment_size", type=int, default=1000, help="Maximum number of products per segment")
+    parser.add_argument("--segment_interval", type=float, default=60, help="Maximum seconds between segments")
+    parser.add_argument("--download_concurrency", type=int, default=5, help="Number of parallel downloads")
+    parser.add_argument("--extract_concurrency", type=int, default=2, help="Number of parallel feature extractions")
+    parser.add_argument("--embed_concurrency", type=int, default=2, help="Number of parallel embedding requests")
+    parser.add_argument("--embed_batch_size", type=int, default=64, help="Maximum number of documents per request")
+    parser.add_argument("--num_retries", type=int, default=3, help="Number of retries of a failed download")
+    parser.add_argument("--retry_backoff", type=float, default=1.0,
+                        help="Base delay in seconds of the exponential backoff between retries")
+    parser.add_argument("--queue_size", type=int, default=1000, help="Capacity of the queue in front of every stage")
+    parser.add_argument("--stats_interval", type=float, default=10, help="Seconds between progress reports")
+    args = parser.parse_args()
+
+    if (args.sitemap_url is None) == (args.urls_file is None):
+        parser.error("Exactly one of --sitemap_url and --urls_file is required")
+    openai.api_key = args.openai_key
+
+    if args.sitemap_url:
+        sources = stream_sitemaps(parse_main_sitemap(args.sitemap_url)[2:], args.sitemap_concurrency)
+    else:
+        sources = read_urls_file(args.urls_file)
+    Pipeline(args).run(sources, args.stats_interval)
+
+
+if __name__ == "__main__":
+    main()
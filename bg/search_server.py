@@ -1,9 +1,18 @@
 import argparse
+import bisect
+import brotli
 import csv
+import hashlib
+import heapq
+import json
 import logging
 import openai
 import os
-from flask import Flask, render_template_string, request
+import re
+import threading
+import time
+import zlib
+from flask import Flask, Response, jsonify, request, stream_with_context
 import numpy as np
 import requests
 
@@ -14,11 +23,73 @@ EXTERNAL_WEBSITE_SEARCH_URL = "https://www.example.com/search"
 app = Flask(__name__)
 
 search_engine = None
+suggester = None
+
+# Candidates scanned per result when collapsing near-duplicate clusters
+COLLAPSE_CANDIDATES = 10
 
 class SearchEngine:
-    def __init__(self, urls_txt, embeddings_npy, data_csv):
+    def __init__(self, urls_txt, embeddings_npy, data_csv, segments_dir=None, segments_reload_seconds=60,
+                 clusters_npy=None):
         self.urls, self.embeddings = self.load_embeddings(urls_txt, embeddings_npy)
         self.data = self.load_data(data_csv)
+        self.clusters = self.load_clusters(clusters_npy, self.urls, self.embeddings)
+
+        # Index delta segments written by pipeline.py are appended as they appear. Rows of products that
+        # reappear in a later segment are masked out of the search and the new row keeps their cluster. New
+        # products in segments are their own cluster until the base index and clusters.npy are rebuilt.
+        self.segments_dir = segments_dir
+        self.segments_reload_seconds = segments_reload_seconds
+        self.loaded_segments = set()
+        self.last_segments_check = 0
+        self.segments_lock = threading.Lock()
+        self.url_rows = {url: i for i, url in enumerate(self.urls)}
+        self.stale_rows = np.zeros(0, dtype=np.int64)
+
+        # Identifies the served index for ETags. Sizes and modification times of the base files are the same in
+        # every worker and change with every redeploy of a new index.
+        self.base_version = ":".join(f"{os.path.basename(path)}={os.path.getsize(path)}@{os.path.getmtime(path)}"
+                                     for path in (urls_txt, embeddings_npy, data_csv, clusters_npy) if path)
+        self.version = hashlib.sha1(self.base_version.encode("utf-8")).hexdigest()
+        self.maybe_load_segments()
+
+    def maybe_load_segments(self):
+        if not self.segments_dir or time.monotonic() - self.last_segments_check < self.segments_reload_seconds:
+            return
+        with self.segments_lock:
+            self.last_segments_check = time.monotonic()
+            if not os.path.isdir(self.segments_dir):
+                return
+            new_segments = sorted(name for name in os.listdir(self.segments_dir)
+                                  if not name.endswith(".tmp") and name not in self.loaded_segments)
+            for name in new_segments:
+                self.load_segment(os.path.join(self.segments_dir, name))
+                self.loaded_segments.add(name)
+            if new_segments:
+                version = ":".join([self.base_version] + sorted(self.loaded_segments))
+                self.version = hashlib.sha1(version.encode("utf-8")).hexdigest()
+
+    def load_segment(self, segment_dir):
+        urls, embeddings = self.load_embeddings(os.path.join(segment_dir, "urls.txt"),
+                                                os.path.join(segment_dir, "embedds.npy"))
+        data = self.load_data(os.path.join(segment_dir, "data.csv"))
+
+        stale_rows = []
+        # Row numbers are never cluster ids of other rows, so new products get their row as cluster id
+        clusters = np.arange(len(self.urls), len(self.urls) + len(urls))
+        for i, url in enumerate(urls):
+            if url in self.url_rows:
+                stale_rows.append(self.url_rows[url])
+                clusters[i] = self.clusters[self.url_rows[url]]
+            self.url_rows[url] = len(self.urls) + i
+        # Swap in complete arrays. Searches read the embeddings first, so they never see more embeddings than urls
+        # or clusters
+        self.data = {**self.data, **data}
+        self.clusters = np.concatenate([self.clusters, clusters])
+        self.urls = np.concatenate([self.urls, urls])
+        self.embeddings = np.concatenate([self.embeddings, embeddings])
+        self.stale_rows = np.concatenate([self.stale_rows, np.array(stale_rows, dtype=np.int64)])
+        logging.info(f"Loaded segment {segment_dir} with {len(urls)} products")
 
     @staticmethod
     def load_embeddings(urls_txt, embeddings_npy):
@@ -31,6 +102,34 @@ class SearchEngine:
 
         return np.array(urls), embeddings
 
+    # Cluster id of every row, from the near-duplicate clusters found by cluster_products.py. Without clusters
+    # every row is its own cluster.
+    @staticmethod
+    def load_clusters(clusters_npy, urls, embeddings):
+        if not clusters_npy:
+            return np.arange(len(urls))
+        clusters = np.load(clusters_npy)
+        if not len(clusters) == len(urls) == len(embeddings):
+            raise ValueError(f"{clusters_npy} has {len(clusters)} rows, but there are {len(urls)} URLs and "
+                             f"{len(embeddings)} embeddings. Rerun cluster_products.py on the current index.")
+        logging.info(f"Loaded {len(np.unique(clusters))} clusters of {len(clusters)} products")
+        return clusters
+
+    # Keeps the best scoring row of every cluster, so that results show one product per cluster and the
+    # variant closest to the query. Only the top candidates are scanned.
+    @staticmethod
+    def collapse(top, sim, clusters, num_results):
+        seen = set()
+        results = []
+        for row in top:
+            if sim[row] == -np.inf or clusters[row] in seen:
+                continue
+            seen.add(clusters[row])
+            results.append(row)
+            if len(results) == num_results:
+                break
+        return results
+
     @staticmethod
     def load_data(data_csv):
         logging.info("Loading data")
@@ -44,9 +143,48 @@ class SearchEngine:
     def search(self, query):
         q_emb = openai.Embedding.create(input=query, engine='text-embedding-ada-002')['data'][0]['embedding']
         q_emb = np.array(q_emb, dtype=np.float32)
-        sim = np.dot(self.embeddings, q_emb)
-        top = np.argsort(sim)[::-1][:30]
-        return [self.data[url] for url in self.urls[top]]
+        self.maybe_load_segments()
+        embeddings, urls, clusters, stale_rows, data = (self.embeddings, self.urls, self.clusters, self.stale_rows,
+                                                        self.data)
+        sim = np.dot(embeddings, q_emb)
+        sim[stale_rows[stale_rows < len(sim)]] = -np.inf
+        top = self.collapse(np.argsort(sim)[::-1][:30 * COLLAPSE_CANDIDATES], sim, clusters, 30)
+        return [data[url] for url in urls[top]]
+
+# Query autocomplete over the sorted prefix index built by build_suggestions.py. Popular prefixes have their
+# suggestions precomputed, any other prefix matches few enough keys to scan them directly.
+class Suggester:
+    def __init__(self, suggest_json):
+        logging.info("Loading suggestions")
+        if suggest_json:
+            with open(suggest_json, encoding="utf-8") as f:
+                index = json.load(f)
+        else:
+            index = {"keys": [], "labels": [], "scores": [], "top": {}, "top_k": 10}
+        self.keys = index["keys"]
+        self.labels = index["labels"]
+        self.scores = index["scores"]
+        self.top = index["top"]
+        self.top_k = index["top_k"]
+        logging.info("Done")
+
+    @staticmethod
+    def normalize(text):
+        return re.sub(r"\s+", " ", text.strip().lower())
+
+    def suggest(self, prefix, limit=10):
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        # Popular prefixes have only `top_k` suggestions, so no prefix returns more than that
+        limit = max(1, min(limit, self.top_k))
+        if prefix in self.top:
+            rows = self.top[prefix][:limit]
+        else:
+            lo = bisect.bisect_left(self.keys, prefix)
+            hi = bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo)
+            rows = heapq.nlargest(limit, range(lo, hi), key=self.scores.__getitem__)
+        return [self.labels[i] for i in rows]
 
 # Generate the search results
 def get_external_search_results(query):
@@ -54,39 +192,9 @@ def get_external_search_results(query):
     return search_url
 
 
-# Define the HTML template for search results
-RESULT_TEMPLATE = """
-<div class="result">
-    <a href="{{ result.url }}" target="_blank" class="result-link">
-        <img src="https:{{ result.picture }}" alt="{{ result.brand }} {{ result.short }}">
-        <div class="result-info">
-            <h3>{{ result.brand }}</h3>
-            <h4>{{ result.short }}</h4>
-            <p>{{ result.price }}</p>
-        </div>
-    </a>
-</div>
-"""
-
-@app.route('/_ah/health')
-def health_check():
-    return "OK", 200
-
-
-# Define the main route
-@app.route("/", methods=["GET"])
-def index():
-    results = []
-    external_results = ""
-
-    query = request.args.get("query")
-    logging.info(f"Received query: {query}")
-    if query:
-        results = search_engine.search(query)
-        results = [render_template_string(RESULT_TEMPLATE, result=result) for result in results]
-        external_results = get_external_search_results(query)
-
-    return render_template_string("""
+# Define the HTML templates. They are compiled once at import time and split in two parts: the page head is
+# sent while the search is still running, the results are rendered in a single pass once it returns.
+PAGE_HEAD_TEMPLATE = app.jinja_env.from_string("""
     <style>
         body {
             font-family: Larsseit sans-serif;
@@ -136,8 +244,20 @@ def index():
     <div style="display: flex;">
         <div style="flex: 1;">
             <div class="results-container">
+""")
+
+PAGE_RESULTS_TEMPLATE = app.jinja_env.from_string("""
                 {% for result in results %}
-                    {{ result | safe }}
+                <div class="result">
+                    <a href="{{ result.url }}" target="_blank" class="result-link">
+                        <img src="https:{{ result.picture }}" alt="{{ result.brand }} {{ result.short }}">
+                        <div class="result-info">
+                            <h3>{{ result.brand }}</h3>
+                            <h4>{{ result.short }}</h4>
+                            <p>{{ result.price }}</p>
+                        </div>
+                    </a>
+                </div>
                 {% endfor %}
             </div>
         </div>
@@ -147,8 +267,71 @@ def index():
             {% endif %}
         </div>
     </div>
-    """,
-                                  results=results, external_results=external_results, RESULT_TEMPLATE=RESULT_TEMPLATE)
+""")
+
+# Identical queries against the same index render the same page, so browsers and proxies may cache it
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", 300))
+
+@app.route('/_ah/health')
+def health_check():
+    return "OK", 200
+
+
+def render_page(query):
+    yield PAGE_HEAD_TEMPLATE.render(query=query)
+    results = []
+    external_results = ""
+    if query:
+        results = search_engine.search(query)
+        external_results = get_external_search_results(query)
+    yield PAGE_RESULTS_TEMPLATE.render(results=results, external_results=external_results)
+
+
+# Compresses every chunk on its own with a flush, so that the browser can render the page head right away
+def compress(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            yield compressor.process(chunk.encode("utf-8")) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+@app.route("/suggest", methods=["GET"])
+def suggest():
+    response = jsonify(suggester.suggest(request.args.get("q", ""), request.args.get("limit", 10, type=int)))
+    response.headers["Cache-Control"] = f"public, max-age={CACHE_MAX_AGE}"
+    return response
+
+
+# Define the main route
+@app.route("/", methods=["GET"])
+def index():
+    query = request.args.get("query", "")
+    logging.info(f"Received query: {query}")
+
+    # The page only depends on the query and on the served index, including segments that appeared just now
+    search_engine.maybe_load_segments()
+    etag = hashlib.sha1(f"{search_engine.version}:{query}".encode("utf-8")).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        chunks = render_page(query)
+        # Respects q=0, unlike `in`, which only checks that the encoding is listed
+        encoding = request.accept_encodings.best_match(["br", "gzip"])
+        if encoding:
+            chunks = compress(chunks, encoding)
+        response = Response(stream_with_context(chunks), mimetype="text/html")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = f"public, max-age={CACHE_MAX_AGE}"
+    response.vary.add("Accept-Encoding")
+    return response
 
 logging.basicConfig(level=logging.INFO)
 
@@ -157,7 +340,11 @@ EXTERNAL_WEBSITE_SEARCH_URL = os.environ.get("EXTERNAL_WEBSITE_SEARCH_URL")
 logging.info(f"Start initializing search engine")
 search_engine = SearchEngine(os.environ.get("URLS_TXT"),
                              os.environ.get("EMBEDDINGS_NPY"),
-                             os.environ.get("DATA_CSV"))
+                             os.environ.get("DATA_CSV"),
+                             os.environ.get("SEGMENTS_DIR"),
+                             float(os.environ.get("SEGMENTS_RELOAD_SECONDS", 60)),
+                             os.environ.get("CLUSTERS_NPY"))
+suggester = Suggester(os.environ.get("SUGGEST_JSON"))
 logging.info(f"Finished")
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import csv
+import hashlib
 import sys
 
 import openai
@@ -16,33 +17,36 @@ def get_embed(doc):
 def main(openai_key, docs_csv, template, output_file, debug=0):
     openai.api_key = openai_key
 
-    # Read existing output file and create a set of processed URLs
-    processed_urls = set()
+    # Read existing output file and map processed URLs to the hash of their embedded document. Rows written
+    # before the hash column existed have None and are not re-embedded.
+    processed_urls = {}
     try:
         with open(output_file, 'r') as f:
             reader = csv.reader(f)
             for row in reader:
-                processed_urls.add(row[0])
+                processed_urls[row[0]] = row[2] if len(row) > 2 else None
     except FileNotFoundError:
         pass  # If the output file does not exist, proceed with an empty set of processed URLs
 
+    # `extract_features.py --incremental` appends a new row for every changed page, the last one is current
     with open(docs_csv, 'r') as f:
-        reader = csv.DictReader(f)
-
-        # Open the output file in append mode
-        with open(output_file, 'a', newline='') as outfile:
-            writer = csv.writer(outfile)
-
-            i = 0
-            for row in tqdm.tqdm(reader):
-                url = row['url']
-                if url not in processed_urls:
-                    doc = template.format(**row)
-                    if debug != 0 and i % debug == 0:
-                        print(doc, file=sys.stderr)
-                    embed = get_embed(doc)
-                    writer.writerow([url, str(embed)])
-                    i += 1
+        rows = {row['url']: row for row in csv.DictReader(f)}
+
+    # Open the output file in append mode. URLs whose document changed get a new row, compress_embedds.py
+    # keeps the last one.
+    with open(output_file, 'a', newline='') as outfile:
+        writer = csv.writer(outfile)
+
+        i = 0
+        for url, row in tqdm.tqdm(rows.items()):
+            doc = template.format(**row)
+            doc_hash = hashlib.sha1(doc.encode('utf-8')).hexdigest()
+            if url not in processed_urls or processed_urls[url] not in (None, doc_hash):
+                if debug != 0 and i % debug == 0:
+                    print(doc, file=sys.stderr)
+                embed = get_embed(doc)
+                writer.writerow([url, str(embed), doc_hash])
+                i += 1
 
 
 if __name__ == '__main__':
@@ -1,15 +1,24 @@
+import asyncio
 import collections
-import concurrent
+import concurrent.futures
+import contextlib
 import copy
+import datetime
+import email.utils
 import hashlib
 import io
+import math
 import os
 import gzip
+import sqlite3
+import threading
 import time
 import urllib
+import zlib
 from collections import deque
 import re
 
+import aiohttp
 import attrdict as attrdict
 import yaml
 from fire import Fire
@@ -38,6 +47,8 @@ class ScrapeQueue:
         self._added = set()
         self._regexps = [re.compile(r) for r in self._config.get('priorities', [])]
         self._queues = [deque() for _ in range(len(self._regexps) + 1)]
+        # URLs are added from pool callbacks while the main thread pops them.
+        self._lock = threading.RLock()
 
     def _url_priority(self, url):
         ps = self._config.get('priorities', [])
@@ -47,20 +58,26 @@ class ScrapeQueue:
         return len(ps)
 
     def add(self, url):
-        if url not in self._added:
-            self._queues[self._url_priority(url)].append(url)
-            print(f"{url}: Scheduled for download.")
-            self._added.add(url)
-        else:
-            print("  " + url + " (skipped)")
+        with self._lock:
+            if url not in self._added:
+                self._queues[self._url_priority(url)].append(url)
+                print(f"{url}: Scheduled for download.")
+                self._added.add(url)
+            else:
+                print("  " + url + " (skipped)")
 
     def pop(self):
-        self._processed_count += 1
-        for q in self._queues:
-            if q:
-                return q.popleft()
+        with self._lock:
+            self._processed_count += 1
+            for q in self._queues:
+                if q:
+                    return q.popleft()
         raise Exception("No more pages to process.")
 
+    # Called once a popped URL has been processed.
+    def done(self, url):
+        pass
+
     @property
     def _processed_count(self):
         return self._state.get('processed_count', 0)
@@ -70,7 +87,8 @@ class ScrapeQueue:
         self._state.processed_count = value
 
     def __bool__(self):
-        return any(self._queues) and self._processed_count < self._config.max_pages
+        with self._lock:
+            return any(self._queues) and self._processed_count < self._config.max_pages
 
     # Save state to file when the scope is left.
     def __enter__(self):
@@ -104,11 +122,350 @@ class ScrapeQueue:
         self._cleanup()
 
 
+# Compact in-memory filter that answers "definitely not seen" for most new URLs, so that the on-disk
+# fingerprint table is only consulted for likely duplicates and false positives.
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self._size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._num_hashes = max(1, round(self._size / capacity * math.log(2)))
+        self.bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, fingerprint):
+        # Double hashing on the two halves of the 64-bit fingerprint.
+        h1 = fingerprint & 0xffffffff
+        h2 = (fingerprint >> 32) & 0xffffffff | 1
+        return ((h1 + i * h2) % self._size for i in range(self._num_hashes))
+
+    def add(self, fingerprint):
+        for pos in self._positions(fingerprint):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(fingerprint))
+
+
+# Same interface as ScrapeQueue, but the frontier lives in an SQLite database. Seen URLs are stored as
+# 64-bit fingerprints only, and changes are committed every `checkpoint_interval` seconds, so a crash loses
+# at most that much work and restoring does not need to load the frontier into memory. URLs that were
+# popped but not marked as done are scheduled again on restore.
+class SqliteScrapeQueue:
+    def __init__(self, base_dir, scrape_config):
+        self._config = scrape_config
+        self._base_dir = base_dir
+        self._regexps = [re.compile(r) for r in self._config.get('priorities', [])]
+        self._lock = threading.RLock()
+        self._in_progress = {}
+        if self._config.get('bloom_capacity', 10_000_000):
+            self._bloom = BloomFilter(self._config.get('bloom_capacity', 10_000_000),
+                                      self._config.get('bloom_error_rate', 0.01))
+        else:
+            self._bloom = None
+
+    def _url_priority(self, url):
+        for i, regex in enumerate(self._regexps):
+            if regex.match(url):
+                return i
+        return len(self._regexps)
+
+    @staticmethod
+    def _fingerprint(url):
+        return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+    def _seen(self, fingerprint):
+        if self._bloom is not None and fingerprint not in self._bloom:
+            return False
+        return self._db.execute('SELECT 1 FROM seen WHERE fingerprint = ?', (fingerprint,)).fetchone() is not None
+
+    def add(self, url):
+        fingerprint = self._fingerprint(url)
+        with self._lock:
+            if not self._seen(fingerprint):
+                self._db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (fingerprint,))
+                self._db.execute('INSERT INTO queue (priority, url, in_progress) VALUES (?, ?, 0)',
+                                 (self._url_priority(url), url))
+                if self._bloom is not None:
+                    self._bloom.add(fingerprint)
+                self._queued += 1
+                print(f"{url}: Scheduled for download.")
+            else:
+                print("  " + url + " (skipped)")
+            self._maybe_checkpoint()
+
+    def pop(self):
+        with self._lock:
+            row = self._db.execute('SELECT id, url FROM queue WHERE in_progress = 0 '
+                                   'ORDER BY priority, id LIMIT 1').fetchone()
+            if row is None:
+                raise Exception("No more pages to process.")
+            self._db.execute('UPDATE queue SET in_progress = 1 WHERE id = ?', (row[0],))
+            self._in_progress[row[1]] = row[0]
+            self._queued -= 1
+            self._processed_count += 1
+            self._maybe_checkpoint()
+            return row[1]
+
+    def done(self, url):
+        with self._lock:
+            self._db.execute('DELETE FROM queue WHERE id = ?', (self._in_progress.pop(url),))
+            self._maybe_checkpoint()
+
+    def __bool__(self):
+        with self._lock:
+            return self._queued > 0 and self._processed_count < self._config.max_pages
+
+    def _maybe_checkpoint(self):
+        if time.monotonic() - self._last_checkpoint >= self._config.get('checkpoint_interval', 10):
+            self.checkpoint()
+
+    def checkpoint(self):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('processed_count', ?)", (self._processed_count,))
+            self._db.commit()
+            self._last_checkpoint = time.monotonic()
+
+    def __enter__(self):
+        fname = os.path.join(self._base_dir, self._config.state_file)
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen (fingerprint INTEGER PRIMARY KEY) WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS queue '
+                         '(id INTEGER PRIMARY KEY, priority INTEGER, url TEXT, in_progress INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS queue_order ON queue (in_progress, priority, id)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+
+        self._db.execute('UPDATE queue SET in_progress = 0 WHERE in_progress = 1')
+        self._queued = self._db.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'processed_count'").fetchone()
+        self._processed_count = row[0] if row else 0
+
+        if self._bloom is not None:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'bloom'").fetchone()
+            if row is not None and len(row[0]) == len(self._bloom.bits):
+                self._bloom.bits = bytearray(row[0])
+            else:
+                for (fingerprint,) in self._db.execute('SELECT fingerprint FROM seen'):
+                    self._bloom.add(fingerprint)
+            # The saved filter is only valid until the frontier changes, a crash has to rebuild it.
+            self._db.execute("DELETE FROM meta WHERE key = 'bloom'")
+        self._db.commit()
+        self._last_checkpoint = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            if self._db is None:
+                return
+            if self._bloom is not None:
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('bloom', ?)", (bytes(self._bloom.bits),))
+            self.checkpoint()
+            self._db.close()
+            self._db = None
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.max_rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    # Takes one token and returns how many seconds the caller has to wait before using it. Tokens may go
+    # negative, so concurrent callers queue up behind each other instead of all waking up at once.
+    def reserve(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return max(0, -self._tokens / self.rate)
+
+    # Empties the bucket until `until`, so that requests resume one by one afterwards.
+    def block(self, until):
+        self._tokens = min(self._tokens, 0)
+        self._updated = max(self._updated, until)
+
+
+# Global and per-host token buckets shared by all workers. Per-host rates follow AIMD: every successful
+# request increases the rate additively up to the configured maximum, every 429/5xx or connection error
+# cuts it multiplicatively. Retry-After blocks the host for the requested time.
+class RateLimiter:
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+    RATE_WINDOW = 10
+
+    def __init__(self, config):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(config.throttle_per_second) if 'throttle_per_second' in config else None
+        self._host_rate = config.get('throttle_per_host_per_second', config.get('throttle_per_second'))
+        self._min_rate = config.get('min_throttle_per_second', 0.1)
+        self._rate_increase = config.get('throttle_increase', 0.1)
+        self._backoff_factor = config.get('throttle_backoff_factor', 0.5)
+        self._stats_interval = config.get('stats_interval', 30)
+        self._hosts = {}
+        self._blocked_until = {}
+        self._completed = deque()
+        self._errors = deque()
+        self._started = self._last_stats_time = time.monotonic()
+
+    @staticmethod
+    def _host(url):
+        return urllib.parse.urlparse(url).netloc
+
+    def _host_bucket(self, host):
+        if self._host_rate is None:
+            return None
+        if host not in self._hosts:
+            self._hosts[host] = TokenBucket(self._host_rate)
+        return self._hosts[host]
+
+    def _reserve(self, url):
+        host = self._host(url)
+        with self._lock:
+            now = time.monotonic()
+            delay = self._blocked_until.get(host, now) - now
+            for bucket in (self._global, self._host_bucket(host)):
+                if bucket is not None:
+                    delay = max(delay, bucket.reserve(now))
+            return delay
+
+    def wait(self, url):
+        delay = self._reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, url):
+        delay = self._reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _parse_retry_after(value):
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return (date - datetime.datetime.now(date.tzinfo)).total_seconds()
+
+    # Records the outcome of a request. `status` is None when the request failed without a response.
+    def record(self, url, status, retry_after=None):
+        host = self._host(url)
+        error = status is None or status in self.RETRYABLE_STATUSES
+        with self._lock:
+            now = time.monotonic()
+            self._completed.append(now)
+            if error:
+                self._errors.append(now)
+            for times in (self._completed, self._errors):
+                while times and times[0] < now - self.RATE_WINDOW:
+                    times.popleft()
+
+            bucket = self._host_bucket(host)
+            if bucket is not None:
+                if error:
+                    bucket.rate = max(self._min_rate, bucket.rate * self._backoff_factor)
+                else:
+                    bucket.rate = min(bucket.max_rate, bucket.rate + self._rate_increase / bucket.rate)
+
+            retry_after = self._parse_retry_after(retry_after)
+            if retry_after is not None and retry_after > 0:
+                if bucket is not None:
+                    bucket.block(now + retry_after)
+                else:
+                    self._blocked_until[host] = max(self._blocked_until.get(host, 0), now + retry_after)
+                print(f"{host}: Retry-After {retry_after:.1f}s")
+
+            print_stats = now - self._last_stats_time >= self._stats_interval
+            if print_stats:
+                self._last_stats_time = now
+        if print_stats:
+            print(self.format_stats())
+
+    def should_retry(self, status):
+        return status in self.RETRYABLE_STATUSES
+
+    # The achieved rate is None during the first second, when too few requests completed to estimate it.
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            for times in (self._completed, self._errors):
+                while times and times[0] < now - self.RATE_WINDOW:
+                    times.popleft()
+            # Until a full window has passed, `_completed` covers the time since the start
+            elapsed = now - self._started
+            achieved_rate = len(self._completed) / min(self.RATE_WINDOW, elapsed) if elapsed >= 1 else None
+            return {'achieved_rate': achieved_rate,
+                    'error_rate': len(self._errors) / max(1, len(self._completed)),
+                    'host_rates': {host: bucket.rate for host, bucket in self._hosts.items()}}
+
+    def format_stats(self):
+        stats = self.stats()
+        hosts = ', '.join(f'{host}: {rate:.2f}/s' for host, rate in stats['host_rates'].items())
+        rate = 'n/a' if stats['achieved_rate'] is None else f"{stats['achieved_rate']:.2f} req/s"
+        return (f"Achieved rate: {rate}, "
+                f"errors: {stats['error_rate']:.1%}, host limits: {hosts or 'none'}")
+
+
+# Remembers the sitemap <lastmod> and the ETag / Last-Modified validators of every fetched URL, so that
+# a re-crawl can skip URLs whose <lastmod> did not change and revalidate the rest with conditional requests.
+class FreshnessStore:
+    def __init__(self, fname):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, lastmod TEXT, '
+                         'fetched_lastmod TEXT, etag TEXT, last_modified TEXT)')
+        self._db.commit()
+
+    def set_lastmods(self, pairs):
+        with self._lock:
+            self._db.executemany('INSERT INTO pages (url, lastmod) VALUES (?, ?) '
+                                 'ON CONFLICT (url) DO UPDATE SET lastmod = excluded.lastmod',
+                                 [(url, lastmod) for url, lastmod in pairs if lastmod])
+            self._db.commit()
+
+    # True if the sitemap says the page did not change since it was last fetched.
+    def is_fresh(self, url):
+        with self._lock:
+            row = self._db.execute('SELECT lastmod, fetched_lastmod FROM pages WHERE url = ?', (url,)).fetchone()
+        return row is not None and row[0] is not None and row[0] == row[1]
+
+    def conditional_headers(self, url):
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified FROM pages WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row is not None and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row is not None and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def record_fetch(self, url, etag, last_modified):
+        with self._lock:
+            self._db.execute('INSERT INTO pages (url, etag, last_modified) VALUES (?, ?, ?) '
+                             'ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, '
+                             'last_modified = excluded.last_modified, fetched_lastmod = lastmod',
+                             (url, etag, last_modified))
+            self._db.commit()
+
+    def record_not_modified(self, url):
+        with self._lock:
+            self._db.execute('UPDATE pages SET fetched_lastmod = lastmod WHERE url = ?', (url,))
+            self._db.commit()
+
+
 class Parser:
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, base_dir, config, queue):
         self._base_dir = base_dir
         self.config = config
-        self._last_request_time = None
+        self._limiter = RateLimiter(config)
         self._queue = queue
 
         # Create dump dir if it doesn't exist.
@@ -116,43 +473,85 @@ class Parser:
         if not os.path.exists(self._dump_dir):
             os.makedirs(self._dump_dir)
 
+        if 'freshness_db' in self.config:
+            self._freshness = FreshnessStore(os.path.join(self._dump_dir, self.config.freshness_db))
+        else:
+            self._freshness = None
+
         self.parsers = collections.OrderedDict()
         for parser in self.config.parsers:
-            if parser.method == 'parse_sitemap':
-                config = copy.deepcopy(parser.config)
-                method = lambda url, cfg=config: self._parse_sitemap(cfg, url)
-            elif parser.method == 'parse_products_gz':
-                config = copy.deepcopy(parser.config)
-                method = lambda url, cfg=config: self._parse_products_gz(cfg, url)
-            elif parser.method == 'dump':
-                method = lambda url: self._dump(url)
-            else:
-                raise Exception("Unknown parser method: " + parser.method)
-            self.parsers[re.compile(parser.pattern)] = method
+            self.parsers[re.compile(parser.pattern)] = self._make_method(parser)
+
+    def _make_method(self, parser):
+        if parser.method == 'parse_sitemap':
+            config = copy.deepcopy(parser.config)
+            return lambda url, cfg=config: self._parse_sitemap(cfg, url)
+        elif parser.method == 'parse_products_gz':
+            config = copy.deepcopy(parser.config)
+            return lambda url, cfg=config: self._parse_products_gz(cfg, url)
+        elif parser.method == 'dump':
+            return lambda url: self._dump(url)
+        else:
+            raise Exception("Unknown parser method: " + parser.method)
 
     def _parse_sitemap(self, config, url):
-        content = self._fetch(url)
+        return self._new_urls(self._fetch(url), self._parse_sitemap_content, config)
+
+    def _parse_products_gz(self, config, url):
+        if config.get('stream', False):
+            stream = SitemapStream(config)
+            for chunk in self._fetch(url, stream=True):
+                self._add_urls(stream.feed(chunk))
+            self._add_urls(stream.close())
+            return []
+        return self._new_urls(self._fetch(url), self._parse_products_gz_content, config)
+
+    # Streamed sitemaps schedule their URLs right away instead of returning them all at the end.
+    def _add_urls(self, pairs):
+        if self._freshness is not None:
+            self._freshness.set_lastmods(pairs)
+        for url, _ in pairs:
+            self._queue.add(url)
+
+    # Parses fetched sitemap content into (url, lastmod) pairs and remembers the lastmods.
+    def _new_urls(self, content, parse_content, config):
+        pairs = parse_content(config, content)
+        if self._freshness is not None:
+            self._freshness.set_lastmods(pairs)
+        return [url for url, _ in pairs]
+
+    @staticmethod
+    def _lastmod(element, config, ns_map):
+        lastmods = element.xpath(config.get('lastmod_xpath', 'sm:lastmod/text()'), namespaces=ns_map)
+        return str(lastmods[0]).strip() if lastmods else None
+
+    @classmethod
+    def _parse_sitemap_content(cls, config, content):
         root = etree.fromstring(content)
         ns_map = {'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9',
                   "re": "http://exslt.org/regular-expressions"}
         result = []
         for match in root.xpath(config.xpath, namespaces=ns_map):
-            result.append(str(match))
+            # Matches are <loc> texts, <lastmod> is a sibling of their <loc>.
+            loc = match.getparent() if isinstance(match, etree._ElementUnicodeResult) else None
+            lastmod = cls._lastmod(loc.getparent(), config, ns_map) if loc is not None else None
+            result.append((str(match), lastmod))
         return result
 
-    def _parse_products_gz(self, config, url):
+    @classmethod
+    def _parse_products_gz_content(cls, config, content):
         result = []
-        content = self._fetch(url)
-        with gzip.open(io.BytesIO(content), 'rt') as f:
+        with gzip.open(io.BytesIO(content), 'rb') as f:
             root = etree.fromstring(f.read())
             ns_map = {'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9',
                       'image': 'http://www.google.com/schemas/sitemap-image/1.1'}
             for product in root.xpath(config.xpath, namespaces=ns_map):
+                lastmod = cls._lastmod(product, config, ns_map)
                 for url in product.xpath(config.url_xpath, namespaces=ns_map):
-                    result.append(str(url))
+                    result.append((str(url), lastmod))
                 if 'image_xpath' in config:
                     for image in product.xpath(config.image_xpath, namespaces=ns_map):
-                        result.append(str(image))
+                        result.append((str(image), None))
         return result
 
     @staticmethod
@@ -166,43 +565,106 @@ class Parser:
         return hash + ext
 
     def _dump(self, url):
+        content = self._fetch(url, conditional=True)
+        if content is None:
+            return
         fname = self._url2fname(url)
         with open(os.path.join(self._dump_dir, fname), 'wb') as f:
             # TODO: Check that there was no redirect and the URL is the same.
-            f.write(self._fetch(url))
+            f.write(content)
+        self._append_index(url)
+
+    # Returns True if the URL does not need to be fetched at all, and conditional request headers otherwise.
+    def _check_freshness(self, url):
+        if self._freshness is None:
+            return False, {}
+        if self._freshness.is_fresh(url):
+            print(f"{url}: Not changed since last crawl (lastmod)")
+            return True, {}
+        # Scraper API does not forward our headers, so only direct requests can be conditional.
+        if 'scraper_api' in self.config:
+            return False, {}
+        return False, self._freshness.conditional_headers(url)
+
+    def _record_fetch(self, url, status, headers):
+        if self._freshness is None:
+            return
+        if status == 304:
+            print(f"{url}: Not modified")
+            self._freshness.record_not_modified(url)
+        else:
+            self._freshness.record_fetch(url, headers.get('ETag'), headers.get('Last-Modified'))
 
+    def _append_index(self, url):
         # Append URL to index file.
         with open(os.path.join(self._dump_dir, 'index.txt'), 'a') as f:
             f.write(url + '\n')
 
-    def _fetch(self, url):
+    def _scraper_api_params(self, url):
+        return {'api_key': self.config.scraper_api.key,
+                'render': False,
+                'country_code': self.config.scraper_api.get('country_code', 'us'),
+                'url': url}
+
+    def _iter_file(self, path):
+        with open(path, 'rb') as f:
+            while chunk := f.read(self.CHUNK_SIZE):
+                yield chunk
+
+    # With `stream` returns an iterator over the body chunks instead of the whole body. Only `conditional`
+    # fetches use the freshness store and return None if the URL did not change since the last crawl. Sitemaps
+    # are always fetched, since unchanged sitemaps can still point to pages that were not crawled yet.
+    def _fetch(self, url, stream=False, conditional=False):
         if urllib.parse.urlparse(url).scheme == 'file':
+            if stream:
+                return self._iter_file(urllib.parse.urlparse(url).path)
             with open(urllib.parse.urlparse(url).path, 'rb') as f:
                 return f.read()
-        elif 'scraper_api' in self.config:
-            payload = {'api_key': self.config.scraper_api.key,
-                       'render': False,
-                       'country_code': self.config.scraper_api.get('country_code', 'us'),
-                       'url': url}
-            response = requests.get('http://api.scraperapi.com', params=payload)
-        else:
-            response = requests.get(url, headers=self.config.get('headers', {}))
 
-        if response.status_code != 200:
+        fresh, conditional_headers = self._check_freshness(url) if conditional else (False, {})
+        if fresh:
+            return None
+
+        for attempt in range(self.config.get('num_retries', 3) + 1):
+            self._limiter.wait(url)
+            try:
+                if 'scraper_api' in self.config:
+                    response = requests.get('http://api.scraperapi.com', params=self._scraper_api_params(url),
+                                            timeout=self.config.get('timeout', 60), stream=stream)
+                else:
+                    response = requests.get(url, headers={**self.config.get('headers', {}), **conditional_headers},
+                                            timeout=self.config.get('timeout', 60), stream=stream)
+            except requests.RequestException:
+                self._limiter.record(url, None)
+                raise
+            self._limiter.record(url, response.status_code, response.headers.get('Retry-After'))
+            if not self._limiter.should_retry(response.status_code) or attempt == self.config.get('num_retries', 3):
+                break
+            response.close()
+            print(f"{url}: Got {response.status_code}, retrying (retry: {attempt + 1})")
+
+        if response.status_code not in (200, 304):
             raise Exception(f"Failed to fetch {url}: {response.status_code}")
+        if response.status_code == 304:
+            self._record_fetch(url, response.status_code, response.headers)
+            return None
+        if stream:
+            return self._iter_response(url, response, conditional)
+        if conditional:
+            self._record_fetch(url, response.status_code, response.headers)
         return response.content
 
+    def _iter_response(self, url, response, conditional):
+        with response:
+            yield from response.iter_content(self.CHUNK_SIZE)
+        # Only remember the validators once the whole body has been consumed.
+        if conditional:
+            self._record_fetch(url, response.status_code, response.headers)
+
     def parse_url(self, url):
         print(f"Processing {url}")
-        # Check if we need to throttle next request.
-        if self._last_request_time and 'throttle_per_second' in self.config:
-            elapsed = time.time() - self._last_request_time
-            if elapsed < 1 / self.config.throttle_per_second:
-                time.sleep(1 / self.config.throttle_per_second - elapsed)
-
         for regex, method in self.parsers.items():
             if regex.search(url):
-                self._last_request_time = time.time()
                 res = method(url)
                 if res is None:
                     res = []
@@ -217,15 +679,18 @@ class Parser:
                 url = self._queue.pop()
                 for new_url in self.parse_url(url):
                     self._queue.add(new_url)
+                self._queue.done(url)
+            print(self._limiter.format_stats())
         else:
             # Multi-threaded mode.
             with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.concurrency) as executor:
                 futures = set()
                 count = 0
-                def done_closure(future):
+                def done_closure(future, url):
                     nonlocal count
                     for new_url in future.result():
                         self._queue.add(new_url)
+                    self._queue.done(url)
                     futures.remove(future)
                     count += 1
 
@@ -239,9 +704,10 @@ class Parser:
                         url = self._queue.pop()
                         future = executor.submit(self.parse_url, url)
                         futures.add(future)
-                        future.add_done_callback(done_closure)
+                        future.add_done_callback(lambda f, url=url: done_closure(f, url))
 
                     print(f'Total of {count} URLs processed.')
+                    print(self._limiter.format_stats())
                 except KeyboardInterrupt:
                     print("Keyboard interrupt, waiting for scraper threads to finish...")
                     executor.shutdown(wait=True)
@@ -249,15 +715,226 @@ class Parser:
                     raise
 
 
+# Incremental parser for sitemaps that are too big to be held in memory. Body chunks are fed as they arrive,
+# gzip is decompressed on the fly, and every <url> element is dropped as soon as it has been parsed.
+class SitemapStream:
+    NS_MAP = {'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9',
+              'image': 'http://www.google.com/schemas/sitemap-image/1.1'}
+
+    def __init__(self, config):
+        self._config = config
+        self._decompressor = None
+        self._started = False
+        self._parser = etree.XMLPullParser(events=('end',), tag='{%s}url' % self.NS_MAP['sm'])
+
+    # Returns (url, lastmod) pairs of the <url> elements completed by this chunk.
+    def feed(self, chunk):
+        if not self._started:
+            self._started = True
+            if chunk[:2] == b'\x1f\x8b':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._parser.feed(self._decompressor.decompress(chunk) if self._decompressor else chunk)
+        return self._read_events()
+
+    def close(self):
+        self._parser.close()
+        return self._read_events()
+
+    def _read_events(self):
+        result = []
+        for _, product in self._parser.read_events():
+            lastmod = Parser._lastmod(product, self._config, self.NS_MAP)
+            for url in product.xpath(self._config.url_xpath, namespaces=self.NS_MAP):
+                result.append((str(url), lastmod))
+            if 'image_xpath' in self._config:
+                for image in product.xpath(self._config.image_xpath, namespaces=self.NS_MAP):
+                    result.append((str(image), None))
+            product.clear()
+            while product.getprevious() is not None:
+                del product.getparent()[0]
+        return result
+
+
+# Runs all requests on a single asyncio event loop. Connections are pooled per host by one shared
+# aiohttp session, so the number of requests in flight is bounded by `concurrency` and
+# `per_host_concurrency` rather than by the number of threads. Dumped pages are streamed to disk.
+class AsyncParser(Parser):
+    def __init__(self, base_dir, config, queue):
+        super().__init__(base_dir, config, queue)
+        self._session = None
+        self._host_semaphores = {}
+
+    def _make_method(self, parser):
+        if parser.method == 'parse_sitemap':
+            config = copy.deepcopy(parser.config)
+            return lambda url, cfg=config: self._parse_async(self._parse_sitemap_content, cfg, url)
+        elif parser.method == 'parse_products_gz':
+            config = copy.deepcopy(parser.config)
+            return lambda url, cfg=config: self._parse_async(self._parse_products_gz_content, cfg, url)
+        elif parser.method == 'dump':
+            return lambda url: self._dump_async(url)
+        else:
+            raise Exception("Unknown parser method: " + parser.method)
+
+    async def _parse_async(self, parse_content, config, url):
+        if config.get('stream', False):
+            return await self._stream_async(config, url)
+        content = await self._fetch_async(url)
+        # Parsing big sitemaps is CPU bound, keep it off the event loop.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._new_urls, content, parse_content, config)
+
+    def _host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.config.get('per_host_concurrency', 2))
+        return self._host_semaphores[host]
+
+    @contextlib.asynccontextmanager
+    async def _get(self, url, headers):
+        async with self._host_semaphore(url):
+            for attempt in range(self.config.get('num_retries', 3) + 1):
+                await self._limiter.wait_async(url)
+                try:
+                    if 'scraper_api' in self.config:
+                        response = await self._session.get('http://api.scraperapi.com',
+                                                           params=self._scraper_api_params(url))
+                    else:
+                        response = await self._session.get(url, headers={**self.config.get('headers', {}), **headers})
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    self._limiter.record(url, None)
+                    raise
+                async with response:
+                    self._limiter.record(url, response.status, response.headers.get('Retry-After'))
+                    if response.status in (200, 304):
+                        yield response
+                        return
+                    if not self._limiter.should_retry(response.status) or attempt == self.config.get('num_retries', 3):
+                        raise Exception(f"Failed to fetch {url}: {response.status}")
+                    print(f"{url}: Got {response.status}, retrying (retry: {attempt + 1})")
+
+    async def _stream_async(self, config, url):
+        loop = asyncio.get_running_loop()
+        async with self._open(url) as chunks:
+            # lxml parsers must stay in the thread that created them, so every stream gets its own thread.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                stream = await loop.run_in_executor(executor, SitemapStream, config)
+                async for chunk in chunks:
+                    self._add_urls(await loop.run_in_executor(executor, stream.feed, chunk))
+                self._add_urls(await loop.run_in_executor(executor, stream.close))
+        return []
+
+    async def _iter_file_async(self, path):
+        for chunk in self._iter_file(path):
+            yield chunk
+
+    # Yields an async iterator over the body chunks. Like in `_fetch`, only `conditional` opens yield None if
+    # the URL did not change since the last crawl.
+    @contextlib.asynccontextmanager
+    async def _open(self, url, conditional=False):
+        if urllib.parse.urlparse(url).scheme == 'file':
+            yield self._iter_file_async(urllib.parse.urlparse(url).path)
+            return
+
+        fresh, conditional_headers = self._check_freshness(url) if conditional else (False, {})
+        if fresh:
+            yield None
+            return
+
+        async with self._get(url, conditional_headers) as response:
+            if response.status == 304:
+                self._record_fetch(url, response.status, response.headers)
+                yield None
+            else:
+                yield response.content.iter_chunked(self.CHUNK_SIZE)
+                # Only remember the validators once the whole body has been consumed.
+                if conditional:
+                    self._record_fetch(url, response.status, response.headers)
+
+    async def _fetch_async(self, url):
+        async with self._open(url) as chunks:
+            return b''.join([chunk async for chunk in chunks])
+
+    async def _dump_async(self, url):
+        fname = os.path.join(self._dump_dir, self._url2fname(url))
+        # Write to a temporary file first so that an interrupted download never leaves a truncated page behind.
+        try:
+            async with self._open(url, conditional=True) as chunks:
+                if chunks is None:
+                    return
+                with open(fname + '.part', 'wb') as f:
+                    async for chunk in chunks:
+                        f.write(chunk)
+        except BaseException:
+            if os.path.exists(fname + '.part'):
+                os.remove(fname + '.part')
+            raise
+        os.replace(fname + '.part', fname)
+        self._append_index(url)
+
+    async def parse_url_async(self, url):
+        print(f"Processing {url}")
+        for regex, method in self.parsers.items():
+            if regex.search(url):
+                try:
+                    res = await method(url)
+                except Exception as e:
+                    print(f"{url}: {e}")
+                    return []
+                if res is None:
+                    res = []
+                return res
+
+        print(f"Could not find parser for {url}")
+        return []
+
+    async def _run(self):
+        concurrency = self.config.get('concurrency', 16)
+        timeout = aiohttp.ClientTimeout(total=self.config.get('timeout', 60),
+                                        connect=self.config.get('connect_timeout', 10))
+        connector = aiohttp.TCPConnector(limit=concurrency,
+                                         limit_per_host=self.config.get('per_host_concurrency', 2))
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self._session = session
+            pending = {}
+            count = 0
+            while True:
+                while self._queue and len(pending) < concurrency:
+                    url = self._queue.pop()
+                    pending[asyncio.ensure_future(self.parse_url_async(url))] = url
+                if not pending:
+                    break
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for new_url in task.result():
+                        self._queue.add(new_url)
+                    self._queue.done(pending.pop(task))
+                    count += 1
+            print(f'Total of {count} URLs processed.')
+            print(self._limiter.format_stats())
+
+    def run(self):
+        asyncio.run(self._run())
+
+
 def main(config, **params):
     base_dir = os.path.dirname(config)
     config = parse_config(config, params)
 
-    with ScrapeQueue(base_dir, config.scrape) as queue:
+    if config.scrape.get('frontier', 'yaml') == 'sqlite':
+        queue = SqliteScrapeQueue(base_dir, config.scrape)
+    else:
+        queue = ScrapeQueue(base_dir, config.scrape)
+
+    with queue:
         for seed in config.seeds:
             queue.add(seed)
 
-        parser = Parser(base_dir, config.parser_config, queue)
+        if config.parser_config.get('engine', 'threads') == 'asyncio':
+            parser = AsyncParser(base_dir, config.parser_config, queue)
+        else:
+            parser = Parser(base_dir, config.parser_config, queue)
         try:
             parser.run()
         except KeyboardInterrupt: